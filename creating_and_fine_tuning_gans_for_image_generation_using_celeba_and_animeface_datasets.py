@@ -477,6 +477,7 @@ def training_step_D(
     optimizer_D: torch.optim.Optimizer,
     BCE_loss: nn.BCELoss,
     is_debug=False,
+    stats=None,
 ):
     """Method of the training step for Discriminator.
 
@@ -486,6 +487,7 @@ def training_step_D(
         model_D: the discriminator model
         optimizer_D: optimizer of the Discriminator
         BCE_loss: binary cross entropy loss function for loss computation
+        stats: optional dictionary that receives the mean outputs D(x) and D(G(z))
 
     Returns:
         loss_D: the discriminator loss
@@ -522,6 +524,10 @@ def training_step_D(
     # Update the parameters of `model_D`
     optimizer_D.step()
 
+    if stats is not None:
+        stats['D_x'] = real_outputs.detach().mean()
+        stats['D_G_z'] = fake_outputs.detach().mean()
+
     if is_debug:
         print('Shape of real outputs:\n', real_outputs.shape, '\n')
         print('Shape and samples of real labels:\n', real_labels.shape, ' ', real_labels[:5], '\n')
@@ -716,3 +722,976 @@ We can also visualize how the quality of the generated images changes during tra
 ani = animation.ArtistAnimation(fig, ims, interval=300, repeat_delay=1000, blit=True)
 HTML(ani.to_jshtml())
 
+"""## Part 4. Train an ensemble of GANs in one batched model
+
+Our generator and discriminator are tiny (at most 128 channels at 32x32), so a single instance leaves most of a many-core CPU idle, and seed or learning-rate studies end up running one after another. Instead, we can stack the parameters of N generators and N discriminators along a new leading dimension and train all of them together.
+
+[`torch.func.stack_module_state()`](https://pytorch.org/docs/stable/generated/torch.func.stack_module_state.html) stacks the parameters and buffers of the N models, and [`torch.func.functional_call()`](https://pytorch.org/docs/stable/generated/torch.func.functional_call.html) runs a model with a given set of parameters. Wrapping the latter in [`torch.func.vmap()`](https://pytorch.org/docs/stable/generated/torch.func.vmap.html) vectorizes the forward and backward passes over all members at once. The BatchNorm running statistics are stacked as well, so each member keeps its own statistics.
+
+### 4.1 Stack the models
+"""
+
+import copy
+
+from torch.func import functional_call, stack_module_state, vmap
+
+class ModelEnsemble:
+    """N copies of one model architecture whose parameters are stacked along dimension 0.
+
+    Args:
+        models: a list of models with the same architecture (e.g., `Generator` instances)
+
+    """
+
+    def __init__(self, models):
+        self.num_members = len(models)
+        self.params, self.buffers = stack_module_state(models)
+
+        # A stateless copy of the model on the 'meta' device is only used for its `forward()`
+        self.base_model = copy.deepcopy(models[0]).to('meta')
+
+    def _forward(self, params, buffers, x):
+        return functional_call(self.base_model, (params, buffers), (x,))
+
+    def __call__(self, x):
+        # `x` has shape (N, B, ...), i.e., one batch for each member
+        return vmap(self._forward)(self.params, self.buffers, x)
+
+    def parameters(self):
+        return list(self.params.values())
+
+    def zero_grad(self):
+        for param in self.params.values():
+            param.grad = None
+
+    def train(self, mode=True):
+        self.base_model.train(mode)
+        return self
+
+    def eval(self):
+        return self.train(False)
+
+    def state_dict(self, index):
+        """Returns the state dictionary of the member `index`, which can be loaded into a single model."""
+        state_dict = {name: param[index].detach().clone() for name, param in self.params.items()}
+        state_dict.update({name: buffer[index].clone() for name, buffer in self.buffers.items()})
+        return state_dict
+
+"""Since each stacked parameter holds the weights of all members, a standard `torch.optim.Adam` would share one learning rate across the whole ensemble. The following optimizer implements the same update rule as `torch.optim.Adam`, but keeps the learning rate as a vector with one entry per member. The moment estimates are stacked like the parameters, so each member has its own Adam state."""
+
+class EnsembleAdam:
+    """Adam optimizer for the stacked parameters of a `ModelEnsemble`.
+
+    Args:
+        params: the stacked parameters, each with shape (N, ...)
+        lrs: the learning rates of the N members
+        betas: coefficients for computing the running averages of the gradient and its square
+        eps: term added to the denominator for numerical stability
+
+    """
+
+    def __init__(self, params, lrs, betas=(0.9, 0.999), eps=1e-8):
+        self.params = list(params)
+        self.lrs = torch.as_tensor(lrs, dtype=torch.float32, device=device)
+        self.betas = betas
+        self.eps = eps
+
+        self.num_steps = 0
+        self.exp_avgs = [torch.zeros_like(param) for param in self.params]
+        self.exp_avg_sqs = [torch.zeros_like(param) for param in self.params]
+
+    def zero_grad(self):
+        for param in self.params:
+            param.grad = None
+
+    @torch.no_grad()
+    def step(self):
+        beta1, beta2 = self.betas
+        self.num_steps += 1
+        bias_correction1 = 1 - beta1 ** self.num_steps
+        bias_correction2_sqrt = (1 - beta2 ** self.num_steps) ** 0.5
+
+        for param, exp_avg, exp_avg_sq in zip(self.params, self.exp_avgs, self.exp_avg_sqs):
+            if param.grad is None:
+                continue
+
+            exp_avg.mul_(beta1).add_(param.grad, alpha=1 - beta1)
+            exp_avg_sq.mul_(beta2).addcmul_(param.grad, param.grad, value=1 - beta2)
+
+            # Broadcast the per-member step sizes over the remaining dimensions of `param`
+            step_size = (self.lrs / bias_correction1).view(-1, *([1] * (param.dim() - 1)))
+            denom = (exp_avg_sq.sqrt() / bias_correction2_sqrt).add_(self.eps)
+            param.sub_(step_size * exp_avg / denom)
+
+"""Similarly to `init_model_and_optimizer()`, we integrate the initialization of the ensemble into one function. If no learning rates are given, every member uses the same `lr` as in Part 3.
+
+Note that the loss function uses `reduction='none'`, so that we can average the loss of each member separately.
+"""
+
+def init_ensemble_and_optimizer(num_members, lrs=None, pretrained=True):
+
+    if lrs is None:
+        lrs = [lr] * num_members
+
+    # Create the instances of Generator and Discriminator for every member
+    models_G = [Generator().to(device) for _ in range(num_members)]
+    models_D = [Discriminator().to(device) for _ in range(num_members)]
+
+    # Load the pre-trained weights for every member
+    if pretrained:
+        for model_G, model_D in zip(models_G, models_D):
+            load_pretrained_weights(model_G, model_D, device)
+
+    ensemble_G = ModelEnsemble(models_G)
+    ensemble_D = ModelEnsemble(models_D)
+
+    # Setup Adam optimizers with one learning rate per member
+    optimizer_G = EnsembleAdam(ensemble_G.parameters(), lrs=lrs, betas=(0.5, 0.999))
+    optimizer_D = EnsembleAdam(ensemble_D.parameters(), lrs=lrs, betas=(0.5, 0.999))
+
+    # Initialize the loss function for training
+    BCE_loss = nn.BCELoss(reduction='none')
+
+    return ensemble_G, ensemble_D, optimizer_G, optimizer_D, BCE_loss
+
+"""### 4.2 Training steps for the ensemble
+
+The training steps follow `training_step_D()` and `training_step_G()`, except that every tensor has an additional leading dimension for the members. All members see the same batch of real images, but each member draws its own noise. The losses are summed over the members before calling `backward()`; since the members do not share any parameters, each member receives exactly the gradients of its own loss.
+"""
+
+def training_step_D_ensemble(
+    real_images,
+    ensemble_G: ModelEnsemble,
+    ensemble_D: ModelEnsemble,
+    optimizer_D: EnsembleAdam,
+    BCE_loss: nn.BCELoss,
+):
+    """Method of the training step for an ensemble of Discriminators.
+
+    Args:
+        real_images: a batch of real image data from the training dataset
+        ensemble_G: the ensemble of generators
+        ensemble_D: the ensemble of discriminators
+        optimizer_D: optimizer of the discriminators
+        BCE_loss: binary cross entropy loss function with `reduction='none'`
+
+    Returns:
+        loss_D: the discriminator losses with shape (N,)
+
+    """
+
+    # Reset the gradients of all parameters in the discriminators
+    ensemble_D.zero_grad()
+
+    num_members = ensemble_D.num_members
+    batch_size = real_images.shape[0]
+
+    # Share the real images between the members and prepare their labels
+    real_images = real_images.to(device).expand(num_members, *real_images.shape)
+    real_labels = torch.ones((num_members, batch_size), device=device)
+
+    # Prepare the fake images and their labels
+    noise = torch.randn((num_members, batch_size, 100, 1, 1), device=device)
+    fake_images = ensemble_G(noise)
+    fake_labels = torch.zeros((num_members, batch_size), device=device)
+
+    # Calculate losses for real and fake images of every member
+    real_outputs = ensemble_D(real_images)
+    loss_D_real = BCE_loss(real_outputs, real_labels).mean(dim=1)
+
+    fake_outputs = ensemble_D(fake_images)
+    loss_D_fake = BCE_loss(fake_outputs, fake_labels).mean(dim=1)
+
+    loss_D = loss_D_real + loss_D_fake
+
+    # Compute gradients of every member and update the parameters
+    loss_D.sum().backward()
+    optimizer_D.step()
+
+    return loss_D
+
+def training_step_G_ensemble(
+    ensemble_G: ModelEnsemble,
+    ensemble_D: ModelEnsemble,
+    optimizer_G: EnsembleAdam,
+    BCE_loss: nn.BCELoss,
+):
+    """Method of the training step for an ensemble of Generators.
+
+    Args:
+        ensemble_G: the ensemble of generators
+        ensemble_D: the ensemble of discriminators
+        optimizer_G: optimizer of the generators
+        BCE_loss: binary cross entropy loss function with `reduction='none'`
+
+    Returns:
+        loss_G: the generator losses with shape (N,)
+
+    """
+
+    # Reset the gradients of all parameters in the generators
+    ensemble_G.zero_grad()
+
+    num_members = ensemble_G.num_members
+
+    # Generate fake images with random noises and prepare their labels
+    noise = torch.randn((num_members, batch_size, 100, 1, 1), device=device)
+    fake_images = ensemble_G(noise)
+    labels = torch.ones((num_members, batch_size), device=device)
+
+    # Calculate the loss of every generator
+    outputs = ensemble_D(fake_images)
+    loss_G = BCE_loss(outputs, labels).mean(dim=1)
+
+    # Compute gradients of every member and update the parameters
+    loss_G.sum().backward()
+    optimizer_G.step()
+
+    return loss_G
+
+"""Let's train an ensemble of four members with different learning rates for a few iterations. Each entry of the printed losses belongs to one member."""
+
+torch.manual_seed(0)
+
+ensemble_lrs = [0.0001, 0.0002, 0.0004, 0.0008]
+ensemble_G, ensemble_D, optimizer_G, optimizer_D, BCE_loss = init_ensemble_and_optimizer(len(ensemble_lrs), lrs=ensemble_lrs)
+
+for i, (real_images, _) in enumerate(dataloader):
+    loss_D = training_step_D_ensemble(real_images, ensemble_G, ensemble_D, optimizer_D, BCE_loss)
+    loss_G = training_step_G_ensemble(ensemble_G, ensemble_D, optimizer_G, BCE_loss)
+
+    print('[Iter][{}] Loss_D: {}, Loss_G: {}'.format(
+        i, [round(loss, 4) for loss in loss_D.tolist()], [round(loss, 4) for loss in loss_G.tolist()]))
+
+    if i == 4:
+        break
+
+# Any member can be extracted into a single generator, e.g., for generating images
+model_G = Generator().to(device)
+model_G.load_state_dict(ensemble_G.state_dict(index=1))
+
+"""### 4.3 Benchmark the ensemble against sequential runs
+
+Finally, we compare the throughput of an ensemble of N members against training N separate GANs one after another. The throughput is measured in real images processed per second over all members. We use random images as in the checks of Part 3, so that loading the dataset does not affect the timings, and skip the pre-trained weights since they do not change the cost of an iteration.
+"""
+
+def benchmark_ensemble(member_counts=(1, 2, 4, 8, 16, 32), num_iters=5):
+
+    real_images = torch.randn((batch_size, 3, 32, 32), device=device)
+    results = []
+
+    for num_members in member_counts:
+        # N separate GANs trained one after another
+        runs = []
+        for _ in range(num_members):
+            model_G = Generator().to(device)
+            model_D = Discriminator().to(device)
+            optimizer_G = torch.optim.Adam(model_G.parameters(), lr=lr, betas=(0.5, 0.999))
+            optimizer_D = torch.optim.Adam(model_D.parameters(), lr=lr, betas=(0.5, 0.999))
+            runs.append((model_G, model_D, optimizer_G, optimizer_D))
+        BCE_loss = nn.BCELoss()
+
+        # Warm up before timing
+        for model_G, model_D, optimizer_G, optimizer_D in runs:
+            training_step_D(real_images, model_G, model_D, optimizer_D, BCE_loss)
+            training_step_G(model_G, model_D, optimizer_G, BCE_loss)
+
+        start_time = time.time()
+        for model_G, model_D, optimizer_G, optimizer_D in runs:
+            for _ in range(num_iters):
+                training_step_D(real_images, model_G, model_D, optimizer_D, BCE_loss)
+                training_step_G(model_G, model_D, optimizer_G, BCE_loss)
+        sequential_time = time.time() - start_time
+
+        # One ensemble of N members
+        ensemble_G, ensemble_D, optimizer_G, optimizer_D, BCE_loss = init_ensemble_and_optimizer(num_members, pretrained=False)
+
+        training_step_D_ensemble(real_images, ensemble_G, ensemble_D, optimizer_D, BCE_loss)
+        training_step_G_ensemble(ensemble_G, ensemble_D, optimizer_G, BCE_loss)
+
+        start_time = time.time()
+        for _ in range(num_iters):
+            training_step_D_ensemble(real_images, ensemble_G, ensemble_D, optimizer_D, BCE_loss)
+            training_step_G_ensemble(ensemble_G, ensemble_D, optimizer_G, BCE_loss)
+        ensemble_time = time.time() - start_time
+
+        num_images = num_members * num_iters * batch_size
+        results.append((num_members, num_images / sequential_time, num_images / ensemble_time))
+
+        print('N: {:2d}, Sequential: {:8.1f} images/s, Ensemble: {:8.1f} images/s, Speedup: {:.2f}x'.format(
+            num_members, num_images / sequential_time, num_images / ensemble_time, sequential_time / ensemble_time))
+
+    return results
+
+ensemble_results = benchmark_ensemble()
+
+plt.figure()
+plt.title("Aggregate training throughput")
+plt.plot([r[0] for r in ensemble_results], [r[1] for r in ensemble_results], marker="o", label="Sequential")
+plt.plot([r[0] for r in ensemble_results], [r[2] for r in ensemble_results], marker="o", label="Ensemble")
+plt.xscale("log", base=2)
+plt.xlabel("Number of members N")
+plt.ylabel("Images per second")
+plt.legend()
+plt.show()
+
+"""## Part 5. Memory-bounded training
+
+In `training_step_D()`, a whole batch of real images and a whole batch of fake images are kept in memory at once, together with all intermediate activations needed for the backward pass. On machines with little memory, this caps the batch size we can train with. We can reduce the memory usage with two techniques:
+- **Gradient accumulation**: we split each logical batch into micro-batches, call `backward()` for each of them, and update the parameters only once per logical batch. This is what bounds the memory usage, since the activations of only one micro-batch are kept at a time.
+- **Activation checkpointing**: with [`torch.utils.checkpoint`](https://pytorch.org/docs/stable/checkpoint.html), only the inputs of the `conv1`...`conv4` blocks are kept during the forward pass, and the activations inside a block are recomputed during the backward pass. Since the blocks only have three layers and their outputs are still kept, the saving is small: for a batch of 1024 images on CPU, the peak RSS of a training step grew by about 460 MB with checkpointing instead of about 520 MB without it, at the cost of a second forward pass. The planner in 5.4 therefore only enables checkpointing when it is what makes the whole batch fit into the budget.
+
+The following code targets CPU training, where the memory usage is measured as the resident set size (RSS) of the process. On a GPU, the activations live in the GPU memory and do not show up in the RSS, so the planner below refuses to run and the example in 5.5 is skipped.
+
+### 5.1 Activation checkpointing
+"""
+
+import resource
+import sys
+from contextlib import contextmanager
+
+from torch.utils.checkpoint import checkpoint
+
+class CheckpointedSequential(nn.Sequential):
+    """`nn.Sequential` whose intermediate activations are recomputed during the backward pass."""
+
+    def forward(self, x):
+        if torch.is_grad_enabled():
+            return checkpoint(super().forward, x, use_reentrant=False)
+        return super().forward(x)
+
+def enable_activation_checkpointing(model):
+    """Replaces the `conv1`...`conv4` blocks of `model` with checkpointed blocks.
+
+    The layers themselves are reused, so the names in the state dictionary do not change.
+    """
+    for name in ('conv1', 'conv2', 'conv3', 'conv4'):
+        block = getattr(model, name)
+        if not isinstance(block, CheckpointedSequential):
+            setattr(model, name, CheckpointedSequential(*block))
+    return model
+
+"""### 5.2 BatchNorm statistics with micro-batches
+
+In training mode, BatchNorm normalizes each micro-batch with the statistics of the micro-batch itself, and this cannot be avoided without keeping the whole batch in memory. However, the running statistics used at inference time should still be updated as if the whole batch had been seen at once: otherwise they would be updated once per micro-batch, and the checkpointed blocks would update them once more when they are recomputed.
+
+The following class records the per-channel mean and mean of squares of the inputs of every BatchNorm layer for each micro-batch, restores the running statistics afterwards, and applies a single update with the statistics of the whole batch. If a layer is called several times per micro-batch (e.g., the discriminator is called for real and for fake images), each call is combined separately and applied in order, just like in `training_step_D()`.
+"""
+
+class BatchNormStatsTracker:
+    """Accumulates the BatchNorm statistics of `models` over the micro-batches of a logical batch.
+
+    Args:
+        models: the models whose BatchNorm layers should be tracked
+
+    """
+
+    def __init__(self, models):
+        self.layers = [layer for model in models for layer in model.modules() if isinstance(layer, nn.BatchNorm2d)]
+        self.stats = {layer: [] for layer in self.layers}
+        self.saved_state = {}
+        self.collecting = False
+
+        for layer in self.layers:
+            layer.register_forward_pre_hook(self._record)
+
+    def _record(self, layer, inputs):
+        # Skip the recomputation of checkpointed blocks during the backward pass
+        if not (self.collecting and layer.training):
+            return
+
+        x = inputs[0].detach()
+        dims = (0, 2, 3)
+        self.stats[layer].append((
+            x.numel() // x.shape[1],
+            x.mean(dim=dims, dtype=torch.float64),
+            x.pow(2).mean(dim=dims, dtype=torch.float64),
+        ))
+
+    @contextmanager
+    def collect(self):
+        self.collecting = True
+        try:
+            yield
+        finally:
+            self.collecting = False
+
+    def begin(self):
+        for layer in self.layers:
+            self.stats[layer] = []
+            self.saved_state[layer] = (
+                layer.running_mean.clone(), layer.running_var.clone(), layer.num_batches_tracked.clone())
+
+    @torch.no_grad()
+    def end(self, num_micro_batches):
+        for layer in self.layers:
+            running_mean, running_var, num_batches_tracked = self.saved_state[layer]
+            layer.running_mean.copy_(running_mean)
+            layer.running_var.copy_(running_var)
+            layer.num_batches_tracked.copy_(num_batches_tracked)
+
+            stats = self.stats[layer]
+            num_calls = len(stats) // num_micro_batches
+            for call in range(num_calls):
+                counts, means, sq_means = zip(*stats[call::num_calls])
+                count = sum(counts)
+                mean = sum(n * m for n, m in zip(counts, means)) / count
+                var = sum(n * s for n, s in zip(counts, sq_means)) / count - mean ** 2
+
+                # Same update rule as `nn.BatchNorm2d`, with the unbiased variance of the whole batch
+                layer.num_batches_tracked.add_(1)
+                if layer.momentum is None:
+                    factor = 1.0 / layer.num_batches_tracked.item()
+                else:
+                    factor = layer.momentum
+                layer.running_mean.mul_(1 - factor).add_(mean.to(layer.running_mean.dtype), alpha=factor)
+                layer.running_var.mul_(1 - factor).add_((var * count / max(count - 1, 1)).to(layer.running_var.dtype), alpha=factor)
+
+            self.stats[layer] = []
+
+"""### 5.3 Training steps with gradient accumulation
+
+The training steps follow `training_step_D()` and `training_step_G()`. The loss of each micro-batch is weighted by its share of the logical batch, so that the accumulated gradients are the same as the gradients of the mean loss over the whole batch.
+"""
+
+def training_step_D_accumulated(
+    real_images,
+    model_G: nn.Module,
+    model_D: nn.Module,
+    optimizer_D: torch.optim.Optimizer,
+    BCE_loss: nn.BCELoss,
+    micro_batch_size: int,
+    bn_tracker: BatchNormStatsTracker,
+):
+    """Method of the training step for Discriminator with gradient accumulation.
+
+    Args:
+        real_images: a batch of real image data from the training dataset
+        model_G: the generator model
+        model_D: the discriminator model
+        optimizer_D: optimizer of the Discriminator
+        BCE_loss: binary cross entropy loss function for loss computation
+        micro_batch_size: the number of images processed at once
+        bn_tracker: the BatchNorm statistics tracker of `model_G` and `model_D`
+
+    Returns:
+        loss_D: the discriminator loss over the whole batch
+
+    """
+
+    # Reset the gradients of all parameters in discriminator
+    model_D.zero_grad()
+
+    batch_size = real_images.shape[0]
+    micro_batches = real_images.split(micro_batch_size)
+    loss_D = 0.0
+
+    bn_tracker.begin()
+    for real_micro_batch in micro_batches:
+        micro_size = real_micro_batch.shape[0]
+
+        # Prepare the real and fake images of the micro-batch and their labels
+        real_micro_batch = real_micro_batch.to(device)
+        real_labels = torch.ones((micro_size,), device=device)
+        fake_labels = torch.zeros((micro_size,), device=device)
+        noise = torch.randn((micro_size, 100, 1, 1), device=device)
+
+        with bn_tracker.collect():
+            fake_images = model_G(noise)
+            real_outputs = model_D(real_micro_batch)
+            fake_outputs = model_D(fake_images)
+
+        loss = BCE_loss(real_outputs, real_labels) + BCE_loss(fake_outputs, fake_labels)
+
+        # Accumulate the gradients weighted by the share of the micro-batch
+        loss = loss * (micro_size / batch_size)
+        loss.backward()
+        loss_D += loss.detach()
+    bn_tracker.end(len(micro_batches))
+
+    # Update the parameters of `model_D`
+    optimizer_D.step()
+
+    return loss_D
+
+def training_step_G_accumulated(
+    model_G: nn.Module,
+    model_D: nn.Module,
+    optimizer_G: torch.optim.Optimizer,
+    BCE_loss: nn.BCELoss,
+    batch_size: int,
+    micro_batch_size: int,
+    bn_tracker: BatchNormStatsTracker,
+):
+    """Method of the training step for Generator with gradient accumulation.
+
+    Args:
+        model_G: the generator model
+        model_D: the discriminator model
+        optimizer_G: optimizer for the generator
+        BCE_loss: binary cross entropy loss function for loss computation
+        batch_size: the number of generated images in the logical batch
+        micro_batch_size: the number of images processed at once
+        bn_tracker: the BatchNorm statistics tracker of `model_G` and `model_D`
+
+    Returns:
+        loss_G: the generator loss over the whole batch
+
+    """
+
+    # Reset the gradients of all parameters in `model_G`
+    model_G.zero_grad()
+
+    micro_sizes = [micro_batch_size] * (batch_size // micro_batch_size)
+    if batch_size % micro_batch_size:
+        micro_sizes.append(batch_size % micro_batch_size)
+    loss_G = 0.0
+
+    bn_tracker.begin()
+    for micro_size in micro_sizes:
+        noise = torch.randn((micro_size, 100, 1, 1), device=device)
+        labels = torch.ones((micro_size,), device=device)
+
+        with bn_tracker.collect():
+            outputs = model_D(model_G(noise))
+
+        # Accumulate the gradients weighted by the share of the micro-batch
+        loss = BCE_loss(outputs, labels) * (micro_size / batch_size)
+        loss.backward()
+        loss_G += loss.detach()
+    bn_tracker.end(len(micro_sizes))
+
+    # Update the parameters of `model_G`
+    optimizer_G.step()
+
+    return loss_G
+
+"""### 5.4 Plan the micro-batches from a memory budget
+
+Rather than choosing the micro-batch size by hand, we derive it from a target peak RSS. Counting the sizes of the activations is not enough: a training step also allocates autograd buffers, oneDNN workspaces and, at the first step, the Adam state, while in-place activations share their memory with the previous layer. Instead, we measure the cost directly. On copies of the models, we run the same accumulated discriminator and generator steps that the training uses, over a whole logical batch, for a few micro-batch sizes. We read the increase of the peak RSS for each of them and fit a fixed cost plus a cost per sample of the micro-batch.
+
+The remaining memory is the budget minus the current RSS of the process, the batch of real images being trained on, and the gradients and Adam state of the models. It is computed after the measurements, since they leave some memory resident in the process. If the whole batch fits, it is used as is, with activation checkpointing only if that is what makes it fit. Otherwise, the largest micro-batch that fits is chosen. Finally, the chosen micro-batch size is checked by measuring one more accumulated step over the whole batch, and reduced if it exceeds the budget.
+
+Note that with `num_workers > 0`, the dataloader loads and prefetches the batches in worker processes, whose RSS is not part of this budget.
+
+The peak RSS is read from `VmHWM` in `/proc/self/status`, which can be reset by writing `5` to `/proc/self/clear_refs`, so that we can measure the peak of a single step or loop rather than the peak over the whole notebook. On other systems, we fall back to the peak RSS of the whole process.
+"""
+
+import ctypes
+import gc
+
+# Micro-batch sizes used for fitting the cost of a training step
+memory_probe_sizes = (32, 64, 128)
+
+# Headroom on top of the fitted cost of a training step
+memory_safety_factor = 1.1
+
+def current_rss_bytes():
+    """Returns the current RSS of the process, or the peak RSS if it is not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return peak_rss_bytes()
+
+def peak_rss_bytes():
+    """Returns the peak RSS of the process since the last call of `reset_peak_rss()`."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # `ru_maxrss` is given in bytes on macOS and in kilobytes on Linux
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+def reset_peak_rss():
+    """Resets the peak RSS to the current RSS (Linux only)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def release_memory():
+    """Returns the memory freed by Python and PyTorch to the operating system where possible."""
+    gc.collect()
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+def measure_step_rss(model_G, model_D, batch_size, micro_batch_sizes, use_checkpointing):
+    """Measures the increase of the peak RSS of one accumulated D step and G step over `batch_size`
+    images for each micro-batch size.
+
+    The steps are run on copies of the models with their own optimizers, so `model_G` and `model_D`
+    are left untouched.
+    """
+    model_G = copy.deepcopy(model_G)
+    model_D = copy.deepcopy(model_D)
+    if use_checkpointing:
+        enable_activation_checkpointing(model_G)
+        enable_activation_checkpointing(model_D)
+
+    optimizer_G = torch.optim.Adam(model_G.parameters(), lr=lr, betas=(0.5, 0.999))
+    optimizer_D = torch.optim.Adam(model_D.parameters(), lr=lr, betas=(0.5, 0.999))
+    BCE_loss = nn.BCELoss()
+    bn_tracker = BatchNormStatsTracker([model_G, model_D])
+
+    # The batch of real images is accounted for separately by the planner
+    real_images = torch.randn((batch_size, 3, image_size, image_size), device=device)
+
+    def run_step(batch_size, micro_batch_size):
+        training_step_D_accumulated(real_images[:batch_size], model_G, model_D, optimizer_D, BCE_loss, micro_batch_size, bn_tracker)
+        training_step_G_accumulated(model_G, model_D, optimizer_G, BCE_loss, batch_size, micro_batch_size, bn_tracker)
+
+    # Allocate the Adam state and the library workspaces before measuring
+    run_step(min(micro_batch_sizes), min(micro_batch_sizes))
+
+    increases = []
+    for micro_batch_size in micro_batch_sizes:
+        release_memory()
+        reset_peak_rss()
+        start_rss = current_rss_bytes()
+        run_step(batch_size, micro_batch_size)
+        increases.append(peak_rss_bytes() - start_rss)
+
+    return increases
+
+def fit_step_rss(model_G, model_D, batch_size, use_checkpointing):
+    """Fits the RSS increase of a training step as `fixed_bytes + sample_bytes * micro_batch_size`."""
+    probe_sizes = [min(size, batch_size) for size in memory_probe_sizes]
+    increases = measure_step_rss(model_G, model_D, batch_size, probe_sizes, use_checkpointing)
+    if len(set(probe_sizes)) < 2:
+        return 0.0, max(max(increases) / probe_sizes[0], 1.0)
+    sample_bytes, fixed_bytes = np.polyfit(probe_sizes, increases, 1)
+    return max(fixed_bytes, 0.0), max(sample_bytes, 1.0)
+
+def plan_micro_batches(batch_size, max_rss_mb, model_G, model_D, max_checks=5):
+    """Chooses the micro-batch size and whether to use activation checkpointing.
+
+    Args:
+        batch_size: the size of the logical batch
+        max_rss_mb: the target peak RSS of the process in megabytes
+        model_G: the generator model
+        model_D: the discriminator model
+        max_checks: the number of times the chosen micro-batch size is measured and reduced
+
+    Returns:
+        micro_batch_size: the number of images processed at once
+        use_checkpointing: whether activation checkpointing should be enabled
+
+    """
+
+    if device.type != 'cpu':
+        raise ValueError('The memory planner measures the RSS of the process and only supports the CPU, not {}'.format(device))
+
+    # The batch of real images being trained on
+    real_batch_bytes = batch_size * 3 * image_size * image_size * 4
+
+    # The gradients and the Adam state of the models are allocated at the first step
+    param_bytes = sum(param.numel() * param.element_size() for model in (model_G, model_D) for param in model.parameters())
+    state_bytes = 3 * param_bytes
+
+    def get_available_bytes():
+        # Measured after the probes, which leave some memory resident in the process
+        release_memory()
+        available_bytes = max_rss_mb * 1024 ** 2 - current_rss_bytes() - real_batch_bytes - state_bytes
+        if available_bytes <= 0:
+            raise ValueError('The memory budget of {} MB is too small: the process already uses {:.0f} MB'.format(
+                max_rss_mb, current_rss_bytes() / 1024 ** 2))
+        return available_bytes
+
+    fixed_bytes, sample_bytes = fit_step_rss(model_G, model_D, batch_size, use_checkpointing=False)
+    available_bytes = get_available_bytes()
+    micro_batch_size = int((available_bytes / memory_safety_factor - fixed_bytes) // sample_bytes)
+    use_checkpointing = False
+
+    if micro_batch_size >= batch_size:
+        micro_batch_size = batch_size
+    else:
+        # Checkpointing saves little, so only use it if the whole batch then fits
+        fixed_bytes, sample_bytes = fit_step_rss(model_G, model_D, batch_size, use_checkpointing=True)
+        available_bytes = get_available_bytes()
+        if memory_safety_factor * (fixed_bytes + sample_bytes * batch_size) <= available_bytes:
+            micro_batch_size, use_checkpointing = batch_size, True
+
+    # Check the chosen micro-batch size with an accumulated step over the whole batch
+    for _ in range(max_checks):
+        if micro_batch_size < 1:
+            break
+        increase = measure_step_rss(model_G, model_D, batch_size, [micro_batch_size], use_checkpointing)[0]
+        available_bytes = get_available_bytes()
+        if memory_safety_factor * increase <= available_bytes:
+            return micro_batch_size, use_checkpointing
+        micro_batch_size = min(micro_batch_size - 1, int(micro_batch_size * available_bytes / increase / memory_safety_factor))
+
+    raise ValueError('The memory budget of {} MB is too small: the process already uses {:.0f} MB'.format(
+        max_rss_mb, current_rss_bytes() / 1024 ** 2))
+
+"""### 5.5 Train with a large effective batch under a memory budget
+
+Now we can train with an effective batch of 1024 images while keeping the peak RSS under the budget. We set the budget to 200 MB above the current RSS of the process, which is not enough for the whole batch, so the planner has to split it. The peak RSS is reset right before the loop, so the final check only covers the budgeted training. The learning rate is kept as in Part 3; you may want to tune it for the larger batch.
+
+Since the budget only applies to the RSS, this example is skipped when training on a GPU.
+"""
+
+def train_under_memory_budget(effective_batch_size, max_rss_mb):
+
+    large_batch_dataloader = torch.utils.data.DataLoader(dataset, batch_size=effective_batch_size, shuffle=True, num_workers=num_workers)
+
+    model_G, model_D, optimizer_G, optimizer_D, BCE_loss = init_model_and_optimizer()
+
+    micro_batch_size, use_checkpointing = plan_micro_batches(effective_batch_size, max_rss_mb, model_G, model_D)
+    print('Micro-batch size: {}, activation checkpointing: {}'.format(micro_batch_size, use_checkpointing))
+
+    if use_checkpointing:
+        enable_activation_checkpointing(model_G)
+        enable_activation_checkpointing(model_D)
+    bn_tracker = BatchNormStatsTracker([model_G, model_D])
+
+    release_memory()
+    reset_peak_rss()
+
+    start_time = time.time()
+    for i, (real_images, _) in enumerate(large_batch_dataloader):
+        loss_D = training_step_D_accumulated(real_images, model_G, model_D, optimizer_D, BCE_loss, micro_batch_size, bn_tracker)
+        loss_G = training_step_G_accumulated(model_G, model_D, optimizer_G, BCE_loss, effective_batch_size, micro_batch_size, bn_tracker)
+
+        if i % 5 == 0:
+            print('[Iter][{}/{}] Loss_D: {:.4f}, Loss_G: {:.4f}, Peak RSS: {:.0f} MB, Time: {:.2f} s'.format(
+                i, len(large_batch_dataloader), loss_D.item(), loss_G.item(), peak_rss_bytes() / 1024 ** 2, time.time() - start_time))
+            start_time = time.time()
+
+    print('Peak RSS: {:.0f} MB (budget: {} MB)'.format(peak_rss_bytes() / 1024 ** 2, max_rss_mb))
+    assert peak_rss_bytes() <= max_rss_mb * 1024 ** 2, 'The training exceeded the memory budget'
+
+    return model_G, model_D
+
+# Effective (logical) batch size and the target peak RSS in megabytes
+effective_batch_size = 1024
+max_rss_mb = int(current_rss_bytes() / 1024 ** 2) + 200
+
+if device.type == 'cpu':
+    model_G, model_D = train_under_memory_budget(effective_batch_size, max_rss_mb)
+else:
+    print('Skipping the memory-bounded training: the memory budget only applies to training on the CPU')
+
+"""## Part 6. Live training telemetry
+
+So far, the progress of the training is only visible through the messages printed every 50 iterations, and the losses are plotted after the training has finished. For long fine-tuning runs, we would like to watch the throughput and the stability of the training while it happens.
+
+The following class collects a few numbers at every training step and publishes aggregated metrics from a background thread, so that the training step itself is not blocked. The metrics are:
+- iterations and images per second, and the share of the time spent waiting for the dataloader (data-wait ratio);
+- quantiles of the generator and discriminator losses, and the means of D(x) and D(G(z)) over the recent iterations;
+- the gradient norms of the generator and the discriminator;
+- the peak RSS and the CPU utilization of the process.
+
+The metrics can be appended as JSON lines to a metrics file and/or served in the [Prometheus text format](https://prometheus.io/docs/instrumenting/exposition_formats/) on a local HTTP endpoint.
+
+### 6.1 The telemetry exporter
+"""
+
+import collections
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def grad_norm(model):
+    """Returns the total L2 norm of the gradients of `model` as a tensor."""
+    norms = [param.grad.detach().norm() for param in model.parameters() if param.grad is not None]
+    if not norms:
+        return torch.zeros((), device=device)
+    return torch.stack(norms).norm()
+
+class TrainingTelemetry:
+    """Publishes training metrics from a background thread.
+
+    Args:
+        metrics_path: the file to which every set of metrics is appended as a JSON line (optional)
+        port: the local port of the Prometheus-style text endpoint (optional)
+        interval: the number of seconds between two publications
+        window: the number of recent iterations used for the loss quantiles and output means
+
+    """
+
+    quantiles = (0.1, 0.5, 0.9)
+
+    def __init__(self, metrics_path=None, port=None, interval=10.0, window=200):
+        self.metrics_path = metrics_path
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._records = collections.deque(maxlen=window)
+        self._num_iters = 0
+        self._num_images = 0
+        self._data_wait_time = 0.0
+        self._last = (time.perf_counter(), 0, 0, 0.0, self._cpu_time())
+        self.metrics = {}
+        self.num_publish_errors = 0
+
+        self._server = None
+        if port is not None:
+            self._server = ThreadingHTTPServer(('127.0.0.1', port), self._make_handler())
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _cpu_time():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+
+    def _make_handler(self):
+        telemetry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = telemetry.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def timed(self, iterable):
+        """Wraps a dataloader and measures the time spent waiting for each batch."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            with self._lock:
+                self._data_wait_time += time.perf_counter() - start
+            yield batch
+
+    def record_step(self, num_images, loss_D, loss_G, grad_norm_D, grad_norm_G, D_x=None, D_G_z=None):
+        """Records one training iteration.
+
+        The values can be tensors; they are only converted to numbers in the background thread.
+        """
+        with self._lock:
+            self._records.append((loss_D.detach(), loss_G.detach(), grad_norm_D, grad_norm_G, D_x, D_G_z))
+            self._num_iters += 1
+            self._num_images += num_images
+
+    def publish(self):
+        with self._lock:
+            records = list(self._records)
+            num_iters, num_images, data_wait_time = self._num_iters, self._num_images, self._data_wait_time
+
+        now, cpu_time = time.perf_counter(), self._cpu_time()
+        last_time, last_iters, last_images, last_data_wait_time, last_cpu_time = self._last
+        self._last = (now, num_iters, num_images, data_wait_time, cpu_time)
+        elapsed = max(now - last_time, 1e-9)
+
+        metrics = {
+            'timestamp': time.time(),
+            'iterations_total': num_iters,
+            'iterations_per_second': (num_iters - last_iters) / elapsed,
+            'images_per_second': (num_images - last_images) / elapsed,
+            'data_wait_ratio': min((data_wait_time - last_data_wait_time) / elapsed, 1.0),
+            'peak_rss_bytes': peak_rss_bytes(),
+            'cpu_utilization': (cpu_time - last_cpu_time) / elapsed / (os.cpu_count() or 1),
+        }
+
+        if records:
+            columns = [[None if value is None else float(value) for value in column] for column in zip(*records)]
+            losses_D, losses_G, grad_norms_D, grad_norms_G, D_x, D_G_z = columns
+            for q in self.quantiles:
+                metrics['loss_D_q{}'.format(q)] = float(np.quantile(losses_D, q))
+                metrics['loss_G_q{}'.format(q)] = float(np.quantile(losses_G, q))
+            metrics['grad_norm_D'] = grad_norms_D[-1]
+            metrics['grad_norm_G'] = grad_norms_G[-1]
+            if None not in D_x:
+                metrics['D_x_mean'] = float(np.mean(D_x))
+                metrics['D_G_z_mean'] = float(np.mean(D_G_z))
+
+        self.metrics = metrics
+
+        if self.metrics_path is not None:
+            with open(self.metrics_path, 'a') as f:
+                f.write(json.dumps(metrics) + '\n')
+
+        return metrics
+
+    def to_prometheus(self):
+        """Formats the latest metrics in the Prometheus text format."""
+        lines = []
+        for name, value in self.metrics.items():
+            if name == 'timestamp':
+                continue
+            if name.startswith(('loss_D_q', 'loss_G_q')):
+                model, quantile = name[5], name[8:]
+                lines.append('gan_loss{{model="{}",quantile="{}"}} {}'.format(model, quantile, value))
+            else:
+                lines.append('gan_{} {}'.format(name, value))
+        # Lets a scraper notice that the metrics above are stale
+        lines.append('gan_publish_errors_total {}'.format(self.num_publish_errors))
+        return '\n'.join(lines) + '\n'
+
+    def _publish_safely(self):
+        # Keep publishing after a failure, e.g., an unwritable `metrics_path`
+        try:
+            self.publish()
+        except Exception:
+            self.num_publish_errors += 1
+            logging.exception('Failed to publish the training telemetry')
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._publish_safely()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._publish_safely()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+"""### 6.2 Train with telemetry
+
+Let's fine-tune the pre-trained GAN again with the telemetry enabled. While the training is running, the latest metrics can be read from `http://127.0.0.1:<telemetry_port>/metrics` (e.g., with `curl` or by a Prometheus server), and their history from `telemetry_metrics_path` (both are set at the top of the following cell). The loop is wrapped in `try`/`finally`, so that interrupting it still stops the background thread and frees the port. To keep this example short, we only train for a few hundred iterations; the same lines can be added to the training loop of 3.4 to watch a full run. Failures while publishing are logged and counted in `gan_publish_errors_total`. Note that the gradient norm of the discriminator has to be computed right after `training_step_D()`, since `training_step_G()` also back-propagates through the discriminator.
+"""
+
+# Local port and metrics file of the training telemetry
+telemetry_port = 8000
+telemetry_metrics_path = 'metrics.jsonl'
+
+model_G, model_D, optimizer_G, optimizer_D, BCE_loss = init_model_and_optimizer()
+
+telemetry = TrainingTelemetry(metrics_path=telemetry_metrics_path, port=telemetry_port)
+step_stats = {}
+
+try:
+    for i, (real_images, _) in enumerate(telemetry.timed(dataloader)):
+        loss_D = training_step_D(real_images, model_G, model_D, optimizer_D, BCE_loss, stats=step_stats)
+        grad_norm_D = grad_norm(model_D)
+
+        loss_G = training_step_G(model_G, model_D, optimizer_G, BCE_loss)
+        grad_norm_G = grad_norm(model_G)
+
+        telemetry.record_step(real_images.shape[0], loss_D, loss_G, grad_norm_D, grad_norm_G, **step_stats)
+
+        if i == 299:
+            break
+finally:
+    telemetry.close()
+
+print(telemetry.to_prometheus())
+